@@ -12,12 +12,17 @@ import glob
 import os
 import sys
 import argparse
+import math
+import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import random
 import numpy as np
 from matplotlib import cm
 import open3d as o3d
+import open3d.core as o3c
+from numba import njit, prange
 
 try:
     sys.path.append(glob.glob('../carla/dist/carla-*%d.%d-%s.egg' % (
@@ -30,9 +35,12 @@ except IndexError:
 import carla
 
 POINT_DIFF_THRESHOLD = 125  # FOR RECORDING ~ Difference in number of points from prev point cloud to capture.
+SEMANTIC_CHUNKS = 64  # Chunks of the semantic point cloud colorized in parallel.
 
 VIRIDIS = np.array(cm.get_cmap('plasma').colors)
-VID_RANGE = np.linspace(0.0, 1.0, VIRIDIS.shape[0])
+VIRIDIS_F32 = np.ascontiguousarray(VIRIDIS, dtype=np.float32)
+VIRIDIS_NEXT = np.vstack([VIRIDIS_F32[1:], VIRIDIS_F32[-1:]]) # upper anchor of every colormap bin
+INTENSITY_LOG_SCALE = -1.0 / (-0.004 * 100) # -1 / log(exp(-0.004 * 100)), the intensity log scale
 LABEL_COLORS = np.array([
     (255, 255, 255), # None [0]
     (128, 64, 128),  # Roads [1]
@@ -63,39 +71,249 @@ LABEL_COLORS = np.array([
     (150, 100, 100), # Bridge [26]
     (230, 150, 140), # RailTrack [27]
     (180, 165, 180), # GuardRail[28]
-]) / 255.0 # normalize each channel [0-1] since this is what Open3D uses
+], dtype=np.float32) / np.float32(255.0) # normalize each channel [0-1] since this is what Open3D uses
 
 # DISABLING OBJECTS FROM POINTCLOUD:
 
-LABEL_COLORS[0] = [0.0, 0.0, 0.0]  # None
-LABEL_COLORS[1] = [0.0, 0.0, 0.0]  # Roads
-LABEL_COLORS[2] = [0.0, 0.0, 0.0]  # Sidewalks
-LABEL_COLORS[10] = [0.0, 0.0, 0.0] # Terrain
-LABEL_COLORS[11] = [0.0, 0.0, 0.0] # Sky
-LABEL_COLORS[24] = [0.0, 0.0, 0.0] # RoadLines
-LABEL_COLORS[26] = [0.0, 0.0, 0.0] # Ground
-LABEL_COLORS[27] = [0.0, 0.0, 0.0] # RailTrack
+LABEL_DISABLED = np.zeros(LABEL_COLORS.shape[0], dtype=np.uint8)
+LABEL_DISABLED[0] = 1   # None
+LABEL_DISABLED[1] = 1   # Roads
+LABEL_DISABLED[2] = 1   # Sidewalks
+LABEL_DISABLED[10] = 1  # Terrain
+LABEL_DISABLED[11] = 1  # Sky
+LABEL_DISABLED[24] = 1  # RoadLines
+LABEL_DISABLED[26] = 1  # Ground
+LABEL_DISABLED[27] = 1  # RailTrack
+
+# CLASSES WHOSE OBJECTS ARE ACTORS WITH THEIR OWN COLOR:
+
+LABEL_ACTOR = np.zeros(LABEL_COLORS.shape[0], dtype=np.uint8)
+LABEL_ACTOR[12] = 1  # Pedestrians
+LABEL_ACTOR[13] = 1  # Rider
+LABEL_ACTOR[14] = 1  # Car
+LABEL_ACTOR[15] = 1  # Truck
+LABEL_ACTOR[16] = 1  # Bus
+LABEL_ACTOR[17] = 1  # Train
+LABEL_ACTOR[18] = 1  # Motorcycle
+LABEL_ACTOR[19] = 1  # Bicycle
+
+@njit(parallel=True, fastmath=True, cache=True)
+def intensity_to_rgb(data, out_rgb, viridis, viridis_next):
+    """Maps the intensity of every point to the colormap
+    in one pass, writing the RGB triplets into out_rgb"""
+    top = viridis.shape[0] - 1
+    for i in prange(out_rgb.shape[0]):
+        intensity = data[i, 3]
+        # Zero intensity returns would give log(0), they map to the bottom of the colormap
+        c = 1.0 + math.log(intensity) * INTENSITY_LOG_SCALE if intensity > 0.0 else 0.0
+        c = 0.0 if c < 0.0 else (1.0 if c > 1.0 else c)
+
+        # The colormap anchors are evenly spaced, so the bin is found directly
+        # and blended with its upper anchor, the last bin being its own upper anchor
+        b = c * top
+        lo = int(b)
+        t = b - lo
+        for k in range(3):
+            out_rgb[i, k] = viridis[lo, k] * (1.0 - t) + viridis_next[lo, k] * t
+
+
+@njit(parallel=True, cache=True)
+def widen_flip_y(xyz, out_xyz):
+    """Copies the float32 xyz view of the lidar points into
+    the float64 out_xyz in one pass, negating the y"""
+    for i in prange(out_xyz.shape[0]):
+        out_xyz[i, 0] = xyz[i, 0]
+        out_xyz[i, 1] = -xyz[i, 1]
+        out_xyz[i, 2] = xyz[i, 2]
+
+
+@njit(parallel=True, cache=True)
+def build_semantic(raw, raw_u32, label_colors, label_disabled, label_actor,
+                   actor_ids_sorted, actor_palette, out_xyz, out_rgb):
+    """Filters and colorizes the semantic lidar points, compacting the kept
+    ones into out_xyz and out_rgb. Returns how many were kept and how many
+    of those belong to an actor class but are missing from actor_ids_sorted"""
+    num_points = raw.shape[0]
+    num_actors = actor_ids_sorted.shape[0]
+    chunk_size = (num_points + SEMANTIC_CHUNKS - 1) // SEMANTIC_CHUNKS
+
+    # Count the points every chunk keeps, skipping the objects we don't want
+    # in the pointcloud, so that the chunks know where to write their points
+    chunk_start = np.zeros(SEMANTIC_CHUNKS + 1, dtype=np.int64)
+    for chunk in prange(SEMANTIC_CHUNKS):
+        kept = 0
+        for i in range(chunk * chunk_size, min(num_points, (chunk + 1) * chunk_size)):
+            if not label_disabled[raw_u32[i, 5]]:
+                kept += 1
+        chunk_start[chunk + 1] = kept
+    chunk_start = np.cumsum(chunk_start)
+
+    chunk_unknown = np.zeros(SEMANTIC_CHUNKS, dtype=np.int64)
+    for chunk in prange(SEMANTIC_CHUNKS):
+        k = chunk_start[chunk]
+        unknown = 0
+        for i in range(chunk * chunk_size, min(num_points, (chunk + 1) * chunk_size)):
+            tag = raw_u32[i, 5]
+            if label_disabled[tag]:
+                continue
+
+            # We're negating the y to correclty visualize a world that matches
+            # what we see in Unreal since Open3D uses a right-handed coordinate system
+            out_xyz[k, 0] = raw[i, 0]
+            out_xyz[k, 1] = -raw[i, 1]
+            out_xyz[k, 2] = raw[i, 2]
+
+            # Look the actor ID up in the sorted actor ids
+            obj_idx = raw_u32[i, 4]
+            lo = 0
+            hi = num_actors
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if actor_ids_sorted[mid] < obj_idx:
+                    lo = mid + 1
+                else:
+                    hi = mid
+
+            # Points of a known actor get its unique color, the rest are colorized
+            # based on the CityScapes color palette
+            if lo < num_actors and actor_ids_sorted[lo] == obj_idx:
+                for c in range(3):
+                    out_rgb[k, c] = actor_palette[lo, c]
+            else:
+                for c in range(3):
+                    out_rgb[k, c] = label_colors[tag, c]
+                if label_actor[tag] and obj_idx != 0:
+                    unknown += 1
+
+            # # In case you want to make the color intensity depending
+            # # of the incident ray angle, you can use:
+            # for c in range(3):
+            #     out_rgb[k, c] *= raw[i, 3]
+
+            k += 1
+        chunk_unknown[chunk] = unknown
+    return chunk_start[SEMANTIC_CHUNKS], chunk_unknown.sum()
+
+
+def warm_up_kernels(semantic):
+    """Compiles the Numba kernels of the lidar callbacks on a dummy
+    frame so the first frames from the sensor don't pay for it"""
+    # Two points since slicing xyz out of a single record would look contiguous
+    # to Numba, and read-only views just like the ones of the raw lidar data
+    scratch = LidarScratch(2)
+    if semantic:
+        raw = np.frombuffer(bytes(2 * 24), dtype=np.float32).reshape(-1, 6)
+        raw_u32 = np.frombuffer(bytes(2 * 24), dtype=np.uint32).reshape(-1, 6)
+        build_semantic(
+            raw, raw_u32, LABEL_COLORS, LABEL_DISABLED, LABEL_ACTOR,
+            np.empty(0, dtype=np.int64), np.empty((0, 3), dtype=np.float32),
+            scratch.xyz, scratch.rgb)
+    else:
+        raw = np.frombuffer(bytes(2 * 16), dtype=np.float32).reshape(-1, 4)
+        intensity_to_rgb(raw, scratch.rgb, VIRIDIS_F32, VIRIDIS_NEXT)
+        widen_flip_y(raw[:, :3], scratch.xyz)
+
+
+def max_points_per_frame(arg, delta):
+    """Upper bound on the number of points the lidar sends in one frame"""
+    # CARLA rounds the points of every channel, so allow one extra point per channel
+    return int(math.ceil(arg.points_per_second * delta)) + int(arg.channels)
+
+
+class LidarScratch(object):
+    """Per-sensor arrays reused by every frame instead of
+    allocating new ones for each point cloud"""
+
+    def __init__(self, n_max):
+        self.xyz = np.empty((n_max, 3), dtype=np.float64)
+        self.rgb = np.empty((n_max, 3), dtype=np.float64)
+
+    def reserve(self, num_points):
+        """Grows the arrays when a frame holds more points than they fit,
+        the kernels don't check bounds and would write past their end"""
+        if num_points > self.xyz.shape[0]:
+            self.xyz = np.empty((num_points, 3), dtype=np.float64)
+            self.rgb = np.empty((num_points, 3), dtype=np.float64)
+
+
+class ActorPalette(object):
+    """Unique colors of the actors, kept as the sorted actor ids
+    along with a palette holding the color of each of them"""
+
+    def __init__(self, actor_ids, seed=0):
+        # Seeded so that every run gives the actors the same colors
+        self._rng = np.random.default_rng(seed)
+        self.ids = np.unique(np.asarray(actor_ids, dtype=np.int64))
+        self.colors = self._rng.random((self.ids.shape[0], 3), dtype=np.float32)
+
+    def add(self, actor_ids):
+        """Assigns a unique color to the actor ids that are not in
+        the palette yet, returns how many of them were added"""
+        new_ids = np.setdiff1d(actor_ids, self.ids).astype(np.int64)
+        if new_ids.shape[0] == 0:
+            return 0
+
+        ids = np.concatenate([self.ids, new_ids])
+        colors = np.concatenate([self.colors, self._rng.random((new_ids.shape[0], 3), dtype=np.float32)])
+        order = np.argsort(ids)
+        self.ids = ids[order]
+        self.colors = colors[order]
+        return new_ids.shape[0]
+
+
+class SharedPointCloud(object):
+    """Open3D point cloud shared between the lidar callback, which fills it
+    in place under the lock, and the render loop, which shows and records it"""
+
+    def __init__(self):
+        self.point_list = o3d.geometry.PointCloud()
+        self.lock = threading.Lock()
+        self._new_frame = False
+
+    @contextmanager
+    def write(self):
+        """Hands the point cloud over to be filled with a new frame"""
+        with self.lock:
+            yield self.point_list
+            self._new_frame = True
+
+    def pop_new_frame(self):
+        """Returns whether a new frame was written since the last call,
+        meant to be called while holding the lock"""
+        new_frame = self._new_frame
+        self._new_frame = False
+        return new_frame
+
+
+def set_point_cloud(point_list, points, colors):
+    """Hands the points and colors over to the Open3D point cloud, patching
+    its existing buffers in place when the number of points did not change"""
+    if len(point_list.points) == points.shape[0] and len(point_list.colors) == colors.shape[0]:
+        np.copyto(np.asarray(point_list.points), points)
+        np.copyto(np.asarray(point_list.colors), colors)
+    else:
+        point_list.points = o3d.utility.Vector3dVector(points)
+        point_list.colors = o3d.utility.Vector3dVector(colors)
+
 
-def lidar_callback(point_cloud, point_list):
+def lidar_callback(point_cloud, shared_cloud, scratch):
     """Prepares a point cloud with intensity
     colors ready to be consumed by Open3D"""
-    data = np.copy(np.frombuffer(point_cloud.raw_data, dtype=np.dtype('f4')))
-    data = np.reshape(data, (int(data.shape[0] / 4), 4))
+    # Every point is x, y, z and intensity (float32), only ever read from the raw buffer
+    raw = np.frombuffer(point_cloud.raw_data, dtype=np.float32).reshape(-1, 4)
+    num_points = raw.shape[0]
+    scratch.reserve(num_points)
 
     # Isolate the intensity and compute a color for it
-    intensity = data[:, -1]
-    intensity_col = 1.0 - np.log(intensity) / np.log(np.exp(-0.004 * 100))
-    int_color = np.c_[
-        np.interp(intensity_col, VID_RANGE, VIRIDIS[:, 0]),
-        np.interp(intensity_col, VID_RANGE, VIRIDIS[:, 1]),
-        np.interp(intensity_col, VID_RANGE, VIRIDIS[:, 2])]
+    int_color = scratch.rgb[:num_points]
+    intensity_to_rgb(raw, int_color, VIRIDIS_F32, VIRIDIS_NEXT)
 
-    # Isolate the 3D data
-    points = data[:, :-1]
-
-    # We're negating the y to correclty visualize a world that matches
-    # what we see in Unreal since Open3D uses a right-handed coordinate system
-    points[:, :1] = -points[:, :1]
+    # Isolate the 3D data into the scratch buffer, the first 12 bytes of every
+    # record viewed as float32 without copying. We're negating the y to correclty
+    # visualize a world that matches what we see in Unreal since Open3D uses a
+    # right-handed coordinate system
+    points = scratch.xyz[:num_points]
+    widen_flip_y(raw[:, :3], points)
 
     # # An example of converting points from sensor to vehicle space if we had
     # # a carla.Transform variable named "tran":
@@ -103,47 +321,58 @@ def lidar_callback(point_cloud, point_list):
     # points = np.dot(tran.get_matrix(), points.T).T
     # points = points[:, :-1]
 
-    point_list.points = o3d.utility.Vector3dVector(points)
-    point_list.colors = o3d.utility.Vector3dVector(int_color)
+    with shared_cloud.write() as point_list:
+        set_point_cloud(point_list, points, int_color)
 
 
-def semantic_lidar_callback(point_cloud, point_list, actor_colors):
+def semantic_lidar_callback(point_cloud, shared_cloud, scratch, actor_palette):
     """Prepares a point cloud with semantic segmentation
     colors ready to be consumed by Open3D"""
-    data = np.frombuffer(point_cloud.raw_data, dtype=np.dtype([
-        ('x', np.float32), ('y', np.float32), ('z', np.float32),
-        ('CosAngle', np.float32), ('ObjIdx', np.uint32), ('ObjTag', np.uint32)]))
-
-    # We're negating the y to correclty visualize a world that matches
-    # what we see in Unreal since Open3D uses a right-handed coordinate system
-    points = np.array([data['x'], -data['y'], data['z']]).T
-
+    # Every point is a 24 byte record of x, y, z, CosAngle (float32) followed
+    # by ObjIdx and ObjTag (uint32), so view the same buffer with both dtypes
+    raw = np.frombuffer(point_cloud.raw_data, dtype=np.float32).reshape(-1, 6)
+    raw_u32 = np.frombuffer(point_cloud.raw_data, dtype=np.uint32).reshape(-1, 6)
+    scratch.reserve(raw.shape[0])
+
+    num_points, num_unknown = build_semantic(
+        raw, raw_u32, LABEL_COLORS, LABEL_DISABLED, LABEL_ACTOR,
+        actor_palette.ids, actor_palette.colors, scratch.xyz, scratch.rgb)
+
+    # Some vehicles or pedestrians showed up since the palette was built,
+    # give them a color and colorize the frame again
+    if num_unknown:
+        tags = raw_u32[:, 5]
+        obj_idx = raw_u32[:, 4][(LABEL_DISABLED[tags] == 0) & (LABEL_ACTOR[tags] == 1)]
+        if actor_palette.add(obj_idx[obj_idx != 0]):
+            num_points, _ = build_semantic(
+                raw, raw_u32, LABEL_COLORS, LABEL_DISABLED, LABEL_ACTOR,
+                actor_palette.ids, actor_palette.colors, scratch.xyz, scratch.rgb)
+    points = scratch.xyz[:num_points]
+    colors = scratch.rgb[:num_points]
 
     # # An example of adding some noise to our data if needed:
     # points += np.random.uniform(-0.05, 0.05, size=points.shape)
 
-    # Colorize the pointcloud based on the CityScapes color palette
-    labels = data['ObjTag']
-    int_color = LABEL_COLORS[labels]
-
-    # Assign unique colors based on actor ID
-    unique_actor_ids = np.unique(data['ObjIdx'])
-    for actor_id in unique_actor_ids:
-        if actor_id in actor_colors:
-            int_color[data['ObjIdx'] == actor_id] = actor_colors[actor_id]
-
+    with shared_cloud.write() as point_list:
+        set_point_cloud(point_list, points, colors)
 
-    # Filter out points with the color (0.0, 0.0, 0.0) which correspond to object we don't want in pointcloud.
-    mask = ~np.all(int_color == [0.0, 0.0, 0.0], axis=1)
-    points = points[mask]
-    int_color = int_color[mask]
 
-    # # In case you want to make the color intensity depending
-    # # of the incident ray angle, you can use:
-    # int_color *= np.array(data['CosAngle'])[:, None]
-
-    point_list.points = o3d.utility.Vector3dVector(points)
-    point_list.colors = o3d.utility.Vector3dVector(int_color)
+def write_ply(file_name, points, colors):
+    """Writes a snapshot of a point cloud to a PLY file with float32
+    positions and 8-bit colors, meant to run on the recording thread"""
+    # A failed recording is only reported, it never interrupts the session
+    try:
+        # The legacy writer stores the positions as doubles, the tensor API writes them as they are typed
+        cloud = o3d.t.geometry.PointCloud()
+        cloud.point['positions'] = o3c.Tensor(points.astype(np.float32))
+        # Clamped and rounded to 8 bits just like the legacy writer does
+        cloud.point['colors'] = o3c.Tensor(np.round(np.clip(colors, 0.0, 1.0) * 255.0).astype(np.uint8))
+        written = o3d.t.io.write_point_cloud(file_name, cloud)
+    except Exception as error:
+        print(f'\nFailed to write {file_name}: {error}')
+    else:
+        if not written:
+            print(f'\nFailed to write {file_name}')
 
 
 def generate_lidar_bp(arg, world, blueprint_library, delta):
@@ -193,20 +422,18 @@ def main(arg):
     client.set_timeout(2.0)
     world = client.get_world()
 
-     # Get the list of actors in the scene
+     # Get the list of actors in the scene the semantic lidar can tell apart,
+     # the other ones (sensors, traffic lights, spectators...) never get a color
     actors = world.get_actors()
+    actors = list(actors.filter('vehicle.*')) + list(actors.filter('walker.*'))
     # print(actors)
 
     previous_num_points = None
-
-    # Create a dictionary to store unique colors for each actor ID
-    actor_colors = {}
+    writer = None
+    pending_write = None
 
     # Assign unique colors to each actor ID
-    for actor in actors:
-        actor_id = actor.id
-        if actor_id not in actor_colors:
-            actor_colors[actor_id] = np.random.random(3)
+    actor_palette = ActorPalette(np.fromiter((actor.id for actor in actors), dtype=np.int64, count=len(actors)))
 
     try:
         original_settings = world.get_settings()
@@ -234,11 +461,14 @@ def main(arg):
 
         lidar = world.spawn_actor(lidar_bp, lidar_transform, attach_to=vehicle)
 
-        point_list = o3d.geometry.PointCloud()
+        shared_cloud = SharedPointCloud()
+        scratch = LidarScratch(max_points_per_frame(arg, delta))
+        warm_up_kernels(arg.semantic)
         if arg.semantic:
-            lidar.listen(lambda data: semantic_lidar_callback(data, point_list, actor_colors))
+            lidar.listen(lambda data: semantic_lidar_callback(
+                data, shared_cloud, scratch, actor_palette))
         else:
-            lidar.listen(lambda data: lidar_callback(data, point_list))
+            lidar.listen(lambda data: lidar_callback(data, shared_cloud, scratch))
 
         vis = o3d.visualization.Visualizer()
         vis.create_window(
@@ -255,43 +485,63 @@ def main(arg):
             add_open3d_axis(vis)
 
         frame = 0
-        dt0 = datetime.now()
+        dt0 = time.perf_counter()
+        fps_time = 0.0
+        fps_frames = 0
 
         if arg.record: # Make the point cloud recording folder if we plan to record
             recording_folder = os.path.join("recordings", str(int(time.time())))
             os.makedirs(recording_folder, exist_ok=True)
 
+            # Write the recordings from a background thread so the disk never stalls the loop
+            writer = ThreadPoolExecutor(max_workers=1)
 
 
-        while True:
-            if frame == 2:
-                vis.add_geometry(point_list)
-            vis.update_geometry(point_list)
-            print(f"~~~~{frame}")
-
-
-            if arg.record:
-
-                # Check if the number of points has changed significantly
-                current_num_points = len(point_list.points)
-                if previous_num_points is None or abs(current_num_points - previous_num_points) > POINT_DIFF_THRESHOLD:
-
-                    # Record the point cloud
-                    ply_file_name = os.path.join(recording_folder, f"frame_{frame:06d}.ply")
-                    o3d.io.write_point_cloud(ply_file_name, point_list)
-
-                    previous_num_points = current_num_points
 
-            vis.poll_events()
-            vis.update_renderer()
+        while True:
+            # The callback fills the point cloud under the lock, so hold it
+            # while the visualizer and the recording read from it
+            with shared_cloud.lock:
+                point_list = shared_cloud.point_list
+                new_frame = shared_cloud.pop_new_frame()
+                if frame == 2:
+                    vis.add_geometry(point_list)
+                # Only upload the point cloud again when the lidar delivered a new one
+                elif frame > 2 and new_frame:
+                    vis.update_geometry(point_list)
+
+
+                if arg.record:
+
+                    # Check if the number of points has changed significantly
+                    current_num_points = len(point_list.points)
+                    if previous_num_points is None or abs(current_num_points - previous_num_points) > POINT_DIFF_THRESHOLD:
+
+                        # Record a snapshot of the point cloud, trying again later if the writer is still busy
+                        if pending_write is None or pending_write.done():
+                            ply_file_name = os.path.join(recording_folder, f"frame_{frame:06d}.ply")
+                            pending_write = writer.submit(
+                                write_ply, ply_file_name,
+                                np.asarray(point_list.points).copy(), np.asarray(point_list.colors).copy())
+
+                            previous_num_points = current_num_points
+
+                vis.poll_events()
+                vis.update_renderer()
             # # This can fix Open3D jittering issues:
             time.sleep(0.005)
             world.tick()
 
-            process_time = datetime.now() - dt0
-            sys.stdout.write('\r' + 'FPS: ' + str(1.0 / process_time.total_seconds()))
-            sys.stdout.flush()
-            dt0 = datetime.now()
+            # Only report the frame rate about twice a second to keep the writes off the loop
+            dt1 = time.perf_counter()
+            fps_time += dt1 - dt0
+            fps_frames += 1
+            dt0 = dt1
+            if fps_time > 0.5:
+                sys.stdout.write(f"\rFPS: {fps_frames / fps_time:.1f} Frame: {frame}")
+                sys.stdout.flush()
+                fps_time = 0.0
+                fps_frames = 0
             frame += 1
 
     finally:
@@ -302,6 +552,10 @@ def main(arg):
         lidar.destroy()
         vis.destroy_window()
 
+        # Let the last recording finish once the simulator is released
+        if writer is not None:
+            writer.shutdown(wait=True)
+
 
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser(